@@ -1,5 +1,7 @@
 from __future__ import print_function
-from abc import ABCMeta, abstractmethod
+import heapq
+import sys
+import threading
 import time
 import math
 
@@ -7,47 +9,175 @@ import boatdclient
 from boatdclient import Bearing
 
 
-def mirror_angle(angle):
-    angle = float(angle)
-    if angle > 180:
-        return 180 - (angle % 180)
-    else:
-        return angle
-
-
 def map_range(x, in_min, in_max, out_min, out_max):
     return (x - in_min) * (out_max - out_min) / (in_max - in_min) + out_min
 
 
+def pid_step(error, integrator, k_p, k_i, integrator_max, output_max,
+             integrate=True):
+    '''
+    Run one step of the PI controller.
+
+    Return a tuple of the clamped output and the new integrator value. The
+    integrator is only advanced when ``integrate`` is true.
+    '''
+    if integrate:
+        integrator += k_i * error
+        if integrator > integrator_max:
+            integrator = integrator_max
+        elif integrator < -integrator_max:
+            integrator = -integrator_max
+
+    out = -(k_p * error + k_i * integrator)
+
+    if out > output_max:
+        out = output_max
+    elif out < -output_max:
+        out = -output_max
+
+    return out, integrator
+
+
+def nearest_points(position, points, k=1):
+    '''
+    Return the ``k`` points in ``points`` closest to ``position``, nearest
+    first.
+    '''
+    return heapq.nsmallest(k, points, key=position.distance_to)
+
+
 def output(*args):
     print('\033c\n')
     for k, v in zip(args[::2], args[1::2]):
         print('\t{}\t| {}'.format(k.ljust(20), v))
 
 
+def sail_angle_for_wind(apparent_wind):
+    '''
+    Return the sail angle for a given apparent wind direction, in degrees
+    relative to the boat.
+    '''
+    apparent_wind = float(apparent_wind + 180) % 360
+
+    if apparent_wind > 180:
+        semicircle_wind = 360 - apparent_wind
+    else:
+        semicircle_wind = apparent_wind
+
+    # linear offset for sail angle output
+    sail_offset = 0
+
+    # maximum and minimum output angles for sail
+    min_sail_angle = 1
+    max_sail_angle = 70
+
+    if semicircle_wind < 45:
+        semicircle_wind = 45
+    elif semicircle_wind > 135:
+        semicircle_wind = 135
+
+    return map_range(semicircle_wind, 45, 135,
+                     min_sail_angle, max_sail_angle) + sail_offset
+
+
+# sail angle for each whole degree of (apparent wind + 180), built once so the
+# main loop only has to do a single index
+SAIL_ANGLE_TABLE = tuple(sail_angle_for_wind(d - 180) for d in range(360))
+
+
+class StaleDataError(Exception):
+    '''Raised when the data from boatd is too old to steer by.'''
+
+
+class BoatPoller(threading.Thread):
+    '''
+    Background thread which keeps a snapshot of the boat's data from boatd.
+
+    Fetching fresh data from boatd is a blocking HTTP request, so doing it
+    here stops slow responses from stalling the control loop, which instead
+    uses whichever snapshot was fetched most recently. Each poll fills a new
+    ``boatdclient.Boat`` which then replaces ``boat`` whole, so a reader
+    holding one snapshot never sees it change underneath it.
+    '''
+
+    def __init__(self, boatd, interval):
+        super(BoatPoller, self).__init__()
+        self.daemon = True
+        self.boatd = boatd
+        self.interval = interval
+
+        self.boat = None
+        # monotonic time of the last successful poll, or None if there hasn't
+        # been one yet
+        self.last_update_time = None
+
+    def poll(self):
+        '''Fetch a new snapshot of the boat's data.'''
+        boat = boatdclient.Boat(boatd=self.boatd, auto_update=False)
+        boat.update()
+        self.boat = boat
+        self.last_update_time = time.monotonic()
+
+    def run(self):
+        # consecutive failed polls. only the first failure and the recovery
+        # are reported, so an outage doesn't flood the output
+        failures = 0
+        while True:
+            start = time.monotonic()
+            try:
+                self.poll()
+            except Exception as e:
+                # keep trying, the control loop will notice if the data gets
+                # too old
+                if failures == 0:
+                    print('error fetching data from boatd: {!r}'.format(e),
+                          file=sys.stderr)
+                failures += 1
+            else:
+                if failures:
+                    print('fetched data from boatd again after {} failed '
+                          'attempts'.format(failures), file=sys.stderr)
+                failures = 0
+            sleep_time = self.interval - (time.monotonic() - start)
+            if sleep_time > 0:
+                time.sleep(sleep_time)
+
+
 class Navigator(object):
     '''
-    Abstract class used to implement behaviours.
+    Base class used to implement behaviours.
 
     This should be inherited from and ``check_new_target`` defined to create a
-    behaviour with some targets. See ``demo-waypoint-behaviour`` for an example
+    behaviour with some targets, or a callable passed as the
+    ``check_new_target`` argument. See ``waypoint-behaviour`` for an example
     of basic waypoint targeting.
     '''
-    __metaclass__ = ABCMeta
 
     def __init__(self,
                  enable_tacking=True,
                  enable_cross_track_minimization=True,
-                 enable_emergency_maneuver=True):
+                 enable_emergency_maneuver=True,
+                 enable_background_polling=True,
+                 check_new_target=None):
         self.enable_tacking = enable_tacking
         self.enable_cross_track_minimization = enable_cross_track_minimization
         self.enable_emergency_maneuver = enable_emergency_maneuver
+        self.enable_background_polling = enable_background_polling
+
+        # optional callable used in place of the check_new_target method
+        self._check_new_target = check_new_target
 
         self.boat = boatdclient.Boat(auto_update=False)
+        self.poller = None
 
         self.target = None
         self.prev_target = None
 
+        # whether target and prev_target are Points rather than Bearings, kept
+        # up to date by set_target and run so update doesn't have to check
+        self._target_is_point = False
+        self._prev_target_is_point = False
+
         # how long the rudder can be hardover for before trying to snap the boat
         # out of it in an emergency
         self.hardover_rudder_timeout = 20
@@ -62,7 +192,7 @@ class Navigator(object):
         self.integrator_max = 1000
 
         # tracks the last time the the rudder was in a good position (i.e. not hard over)
-        self.last_time_rudder_not_maxed = time.time()
+        self.last_time_rudder_not_maxed = time.monotonic()
 
         self.tacking_left = None
         self.tacking_right = None
@@ -74,204 +204,298 @@ class Navigator(object):
 
         self.cross_track_error = 0
 
+        # the last angles sent to boatd, and how far the new angle has to move
+        # from them before it is worth sending again
+        self._last_rudder = None
+        self._last_sail = None
+        self.rudder_deadband = 1.0
+        self.sail_deadband = 2.0
+
+        # seconds after which both angles are sent again even if unchanged, so
+        # the actuators recover if boatd restarts and loses them
+        self.actuator_refresh_interval = 1.0
+        self.next_actuator_refresh_time = 0
+
+        # seconds between iterations of the main loop
+        self.update_interval = 0.1
+
+        # how old the latest data from the background poller can get, in
+        # seconds, before we refuse to keep steering by it
+        self.max_data_age = 1.0
+
+        # seconds between debug output updates, or None to disable the output
+        # entirely on a headless boat
+        self.log_interval = 1
         self.next_log_time = 0
 
-    def override_rudder(self, rudder_angle):
-        timeout = time.time() + 10
+    @property
+    def cone_angle(self):
+        '''Half-width of the cone around the wind we stay on one tack in.'''
+        return self._cone_angle
+
+    @cone_angle.setter
+    def cone_angle(self, value):
+        # keep a float copy so the main loop doesn't convert it every tick
+        self._cone_angle = value
+        self._cone_f = float(value)
+
+    @property
+    def tacking_angle(self):
+        '''Angle from the wind to sail at when tacking.'''
+        return self._tacking_angle
+
+    @tacking_angle.setter
+    def tacking_angle(self, value):
+        self._tacking_angle = value
+        self._tack_f = float(value)
+
+    def override_rudder(self, rudder_angle, timeout=10, poll_interval=0.1):
+        '''
+        Put the rudder hard over the opposite way to ``rudder_angle`` until the
+        boat has turned most of the way around, or ``timeout`` seconds pass.
+        '''
+        deadline = time.monotonic() + timeout
         initial_heading = self.boat.heading
 
         rudder_angle = -45 if rudder_angle > 0 else 45
         self.boat.set_rudder(rudder_angle)
-        while time.time() < timeout and \
-                abs(initial_heading.delta(self.boat.heading)) < 170:
-            time.sleep(0.1)
+        self._last_rudder = rudder_angle
+        self.rudder_angle = rudder_angle
+
+        # bound the number of polls as well as the time, so a stalled clock
+        # can't leave us stuck here
+        for _ in range(int(timeout / poll_interval)):
+            if time.monotonic() >= deadline:
+                break
+            try:
+                self.refresh_boat()
+            except StaleDataError:
+                # no new heading to check this time, keep waiting
+                pass
+            else:
+                if abs(initial_heading.delta(self.boat.heading)) >= 170:
+                    break
+            time.sleep(poll_interval)
+
+    def refresh_boat(self):
+        '''
+        Make ``self.boat`` hold the latest data from boatd.
+
+        Raise ``StaleDataError`` if the background poller hasn't managed to
+        fetch any data for longer than ``max_data_age``.
+        '''
+        poller = self.poller
+        if poller is None:
+            self.boat.update()
+            return
+
+        last_update_time = poller.last_update_time
+        if last_update_time is None or \
+           time.monotonic() - last_update_time > self.max_data_age:
+            raise StaleDataError(
+                'no data from boatd for over {} seconds'.format(
+                    self.max_data_age))
+        self.boat = poller.boat
 
     def set_target(self, value):
         '''Set the target angle for the boat.'''
         self.target = value
+        self._target_is_point = isinstance(value, boatdclient.Point)
         self.integrator = 0
 
     def update(self):
         '''Update actuators to make progress towards target.'''
-
-        # this currently always assumes that self.target will return a long/lat
-        # point
-        current_heading = self.boat.heading
-        if isinstance(self.target, boatdclient.Point):
-            target_heading = self.boat.position.bearing_to(self.target)
+        # bind everything used more than once per tick to locals
+        boat = self.boat
+        position = boat.position
+        wind = boat.wind
+        wind_dir = float(wind.absolute)
+        target = self.target
+        rudder_angle_max = self.rudder_angle_max
+        now = time.monotonic
+
+        # headings are worked with as plain floats in degrees from here on, to
+        # avoid creating a new Bearing for every bit of arithmetic
+        current_heading = float(boat.heading)
+        target_is_point = self._target_is_point
+        if target_is_point:
+            target_heading = float(position.bearing_to(target))
         else:
-            target_heading = self.target
+            target_heading = float(target)
 
         if self.enable_cross_track_minimization:
-            if isinstance(self.prev_target, boatdclient.Point) and isinstance(self.target, boatdclient.Point):
+            if self._prev_target_is_point and target_is_point:
                 # TODO find ideal constant to properly scale up/down effects of cross track error
-                self.cross_track_error = self.boat.position.cross_track_distance(self.prev_target, self.target) * 5
+                self.cross_track_error = position.cross_track_distance(self.prev_target, target) * 5
             else:
                 self.cross_track_error = 0
 
-        # tacking logic
-        if abs(target_heading.delta(self.boat.wind.absolute)) <=\
-           self.tacking_angle and self.enable_tacking:
-            bearing_to_wind = self.boat.position.bearing_to(self.target) -\
-                              self.boat.wind.absolute
-
-            # choose the best initial tack, based on which side of the cone
-            # we're on
-            if self.tacking_right is None or self.tacking_left is None:
-                if bearing_to_wind <= 180:
-                    self.tacking_right = True
-                    self.tacking_left = False
-                else:
-                    self.tacking_right = False
-                    self.tacking_left = True
-
-            # just between 0 and 180 degrees, needed to reduce if statements as cone is reflected
-            modulus_to_wind = mirror_angle(bearing_to_wind)
-
-            # detect if the boat is outside cone
-            if modulus_to_wind >= float(self.cone_angle):
-                if bearing_to_wind <= 180:
-                    target_heading = self.boat.wind.absolute + \
-                                     self.tacking_angle
-                    self.tacking_right = True
-                    self.tacking_left = False
-                if bearing_to_wind > 180:
-                    target_heading = self.boat.wind.absolute - \
-                                     self.tacking_angle
-                    self.tacking_right = False
-                    self.tacking_left = True
-
-            # else the boat is inside cone
+        # tacking logic. wind_to_target is the signed angle from the wind to
+        # the target heading, between -180 and 180 degrees, positive when the
+        # target is clockwise of the wind
+        wind_to_target = (target_heading - wind_dir + 180.0) % 360.0 - 180.0
+
+        if abs(wind_to_target) <= self._tack_f and self.enable_tacking:
+            # pick the tack on the same side of the wind as the target when we
+            # first start tacking, or whenever we're outside the cone.
+            # otherwise, inside the cone, stick with the current tack
+            if self.tacking_right is None or \
+               abs(wind_to_target) >= self._cone_f:
+                self.tacking_right = wind_to_target >= 0
+                self.tacking_left = not self.tacking_right
+
+            if self.tacking_right:
+                target_heading = (wind_dir + self._tack_f) % 360.0
             else:
-                if self.tacking_left is True:
-                    target_heading = self.boat.wind.absolute - \
-                                     self.tacking_angle
-                if self.tacking_right is True:
-                    target_heading = self.boat.wind.absolute + \
-                                     self.tacking_angle
+                target_heading = (wind_dir - self._tack_f) % 360.0
         else:
             self.tacking_left = None
             self.tacking_right = None
 
         # FIXME check if both values are of the correct sign with respect to
         # eachother
-        error = current_heading.delta(target_heading) - self.cross_track_error
+        error = (target_heading - current_heading + 180.0) % 360.0 - 180.0 - \
+            self.cross_track_error
 
         # only integrate if the rudder is not at maximum position
-        if -self.rudder_angle_max < self.rudder_angle < self.rudder_angle_max:
-            self.integrator += self.k_i * error
-            if self.integrator > self.integrator_max:
-                self.integrator = self.integrator_max
-            elif self.integrator < -self.integrator_max:
-                self.integrator = -self.integrator_max
-
-        rudder_angle = -(self.k_p * error + self.k_i * self.integrator)
-
-        if rudder_angle > self.rudder_angle_max:
-            rudder_angle = self.rudder_angle_max
-        if rudder_angle < -self.rudder_angle_max:
-            rudder_angle = -self.rudder_angle_max
-
-        self.rudder_angle = rudder_angle
+        rudder_angle, self.integrator = pid_step(
+            error, self.integrator, self.k_p, self.k_i, self.integrator_max,
+            rudder_angle_max,
+            -rudder_angle_max < self.rudder_angle < rudder_angle_max)
 
         # emergency procedure to get the boat to turn the opposite direction
         # when stuck trying to turn towards a target heading
         if self.enable_emergency_maneuver:
             if abs(rudder_angle) < self.hardover_rudder_threshold:
-                self.last_time_rudder_not_maxed = time.time()
-            elif time.time() - self.last_time_rudder_not_maxed > self.hardover_rudder_timeout:
+                self.last_time_rudder_not_maxed = now()
+            elif now() - self.last_time_rudder_not_maxed > self.hardover_rudder_timeout:
                 self.override_rudder(rudder_angle)
 
                 # allow 60 seconds to recover from the maneuver
-                self.last_time_rudder_not_maxed = time.time() + 60
-
-        sail_angle = self.choose_sail_angle()
-
-        self.boat.set_rudder(rudder_angle)
-        self.boat.set_sail(sail_angle)
+                self.last_time_rudder_not_maxed = now() + 60
+
+        sail_angle = self.choose_sail_angle(wind)
+
+        refresh_time = now()
+        refresh = self.next_actuator_refresh_time <= refresh_time
+        if refresh:
+            self.next_actuator_refresh_time = \
+                refresh_time + self.actuator_refresh_interval
+
+        # self.rudder_angle follows what boatd was actually sent, since that's
+        # where the rudder really is
+        last_rudder = self._last_rudder
+        if refresh or last_rudder is None or \
+           abs(rudder_angle - last_rudder) > self.rudder_deadband:
+            boat.set_rudder(rudder_angle)
+            self._last_rudder = rudder_angle
+            self.rudder_angle = rudder_angle
+
+        last_sail = self._last_sail
+        if refresh or last_sail is None or \
+           abs(sail_angle - last_sail) > self.sail_deadband:
+            boat.set_sail(sail_angle)
+            self._last_sail = sail_angle
 
         # output some debug information
-        if self.next_log_time <= time.time():
-            self.next_log_time = time.time() + 1
-            distance = self.boat.position.distance_to(self.target)
+        log_interval = self.log_interval
+        log_time = now()
+        if log_interval is not None and self.next_log_time <= log_time:
+            self.next_log_time = log_time + log_interval
+            distance = position.distance_to(target)
             output(
                 'distance to point', '{:.1f}'.format(distance),
                 'current_point', getattr(self, 'current_point'),
-                'boat position', self.boat.position,
-                'target', self.target,
+                'boat position', position,
+                'target', target,
                 '', '',
-                'heading', current_heading,
-                'desired heading', target_heading,
+                'heading', '{:.1f}'.format(current_heading),
+                'desired heading', '{:.1f}'.format(target_heading),
                 'heading error', '{:.1f}'.format(error),
                 'heading integrator', '{:.1f}'.format(self.integrator),
                 'rudder angle', '{:.1f}'.format(rudder_angle),
                 '', '',
-                'apparent wind', '{:.1f}'.format(float(self.boat.wind.apparent)),
-                'absolute wind', '{:.1f}'.format(float(self.boat.wind.absolute)),
+                'apparent wind', '{:.1f}'.format(float(wind.apparent)),
+                'absolute wind', '{:.1f}'.format(wind_dir),
                 'sail angle', '{:.1f}'.format(sail_angle),
                 '', '',
                 'tacking_left', self.tacking_left,
                 'tacking_right', self.tacking_right,
             )
 
-    def choose_sail_angle(self):
+    def choose_sail_angle(self, wind=None):
         '''
         Return the correct angle to set the sail based on current wind
         direction.
-        '''
-
-        apparent_wind = float(self.boat.wind.apparent + 180)
-
-        if apparent_wind > 180:
-            semicircle_wind = 360 - apparent_wind
-        else:
-            semicircle_wind = apparent_wind
 
-        # linear offset for sail angle output
-        sail_offset = 0
-
-        # maximum and minimum output angles for sail
-        min_sail_angle = 1
-        max_sail_angle = 70
-
-        if semicircle_wind < 45:
-            semicircle_wind = 45
-        elif semicircle_wind > 135:
-            semicircle_wind = 135
-
-        sail_angle = map_range(semicircle_wind, 45, 135,
-                               min_sail_angle, max_sail_angle) + sail_offset
-
-        return sail_angle
-	#return sail_angle
+        ``wind`` can be passed in to reuse wind data already read from the
+        boat, otherwise it is read again.
+        '''
+        if wind is None:
+            wind = self.boat.wind
+        return SAIL_ANGLE_TABLE[int(float(wind.apparent) + 180) % 360]
 
     def run(self):
         '''
         Run the main loop for the behaviour.
         '''
-        while True:
-            time1 = time.time()
-
-            self.boat.update()
-            target = self.check_new_target()
-            if target is not None:
-                self.prev_target = self.target
-                self.set_target(target)
+        if self.enable_background_polling:
+            # poll once up front so a boatd that isn't reachable at all fails
+            # loudly here
+            self.poller = BoatPoller(self.boat.boatd, self.update_interval)
+            self.poller.poll()
+            self.poller.start()
 
-            self.update()
+        check_new_target = self._check_new_target or self.check_new_target
 
-            # FIXME: remove this timing information after
-            # https://github.com/boatd/boatd/issues/68 is somewhat completed
-            time2 = time.time()
-            with open('timing', 'a') as f:
-                f.write('{}\n'.format(time2-time1))
+        stale = False
+        next_update_time = time.monotonic()
+        while True:
+            time1 = time.monotonic()
+
+            try:
+                self.refresh_boat()
+            except StaleDataError as e:
+                # don't steer on old data, but keep ticking so we carry on
+                # as soon as the poller gets through to boatd again
+                if not stale:
+                    print('{}, waiting for fresh data'.format(e),
+                          file=sys.stderr)
+                    stale = True
+            else:
+                if stale:
+                    print('fresh data from boatd, resuming', file=sys.stderr)
+                    stale = False
+
+                target = check_new_target()
+                if target is not None:
+                    self.prev_target = self.target
+                    self._prev_target_is_point = self._target_is_point
+                    self.set_target(target)
+
+                self.update()
+
+                # FIXME: remove this timing information after
+                # https://github.com/boatd/boatd/issues/68 is somewhat completed
+                time2 = time.monotonic()
+                with open('timing', 'a') as f:
+                    f.write('{}\n'.format(time2-time1))
+
+            # sleep until the next update is due. if we've overrun by more
+            # than a whole interval, drop the missed updates rather than
+            # running several back to back to catch up
+            next_update_time += self.update_interval
+            sleep_time = next_update_time - time.monotonic()
+            if sleep_time > 0:
+                time.sleep(sleep_time)
+            elif -sleep_time > self.update_interval:
+                next_update_time = time.monotonic()
 
-    @abstractmethod
     def check_new_target(self):
         '''
         Check if a new target point needs to be selected.
 
-        Return a new ``Point`` or ``Bearing` if target will be changed,
+        Return a new ``Point`` or ``Bearing`` if target will be changed,
         ``None`` otherwise.
         '''
-        pass
+        raise NotImplementedError
@@ -0,0 +1,53 @@
+import time
+
+from boatdclient import Point
+
+from navigate import Navigator, StaleDataError, nearest_points
+
+
+class FakePoller(object):
+    def __init__(self, boat, last_update_time):
+        self.boat = boat
+        self.last_update_time = last_update_time
+
+
+def test_nearest_points():
+    position = Point(52.4174, -4.0858)
+    far = Point(52.4274, -4.0858)
+    near = Point(52.4175, -4.0858)
+    middle = Point(52.4184, -4.0858)
+
+    assert nearest_points(position, [far, near, middle]) == [near]
+    assert nearest_points(position, [far, near, middle], 2) == [near, middle]
+    assert nearest_points(position, [far, near], 5) == [near, far]
+
+
+def test_refresh_boat_fresh():
+    navigator = Navigator()
+    boat = object()
+    navigator.poller = FakePoller(boat, time.monotonic())
+
+    navigator.refresh_boat()
+    assert navigator.boat is boat
+
+
+def test_refresh_boat_stale():
+    navigator = Navigator()
+    old_boat = navigator.boat
+
+    for last_update_time in (None,
+                             time.monotonic() - navigator.max_data_age - 1):
+        navigator.poller = FakePoller(object(), last_update_time)
+        try:
+            navigator.refresh_boat()
+        except StaleDataError:
+            pass
+        else:
+            assert False, 'StaleDataError not raised'
+        assert navigator.boat is old_boat
+
+
+if __name__ == '__main__':
+    test_nearest_points()
+    test_refresh_boat_fresh()
+    test_refresh_boat_stale()